@@ -1,8 +1,16 @@
 # main.py (updated)
 
+import os
+import sys
+import math
+import signal
+import atexit
+import copy
 import time
+import threading
 import requests
 import json
+from array import array
 from datetime import datetime, timedelta
 from collections import defaultdict
 from pathlib import Path
@@ -11,6 +19,11 @@ from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, Conversa
 
 from bingx_client import BingxClient
 
+try:
+    import orjson  # опционально: быстрый JSON-бэкенд
+except ImportError:
+    orjson = None
+
 # =====================================================
 # ================== CONFIG ===========================
 # =====================================================
@@ -23,9 +36,12 @@ def load_users():
     return {}
 
 def save_users(users):
-    USERS_FILE.write_text(json.dumps(users, indent=4))
+    # Пишем во временный файл и подменяем — users.json никогда не бывает недописанным
+    tmp = USERS_FILE.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(users, indent=4))
+    os.replace(tmp, USERS_FILE)
 
-users = load_users()
+USERS_SAVE_DEBOUNCE_SEC = 1.0  # серия кликов в настройках -> одна запись на диск
 
 BINANCE_FAPI_URL = "https://fapi.binance.com"
 
@@ -37,18 +53,261 @@ OI_4H_THRESHOLD = 10.0     # %
 OI_24H_THRESHOLD = 16.0    # % 
 
 PRICE_OI_RATIO = 0.5     # price_growth <= oi_growth * ratio
+
+# Окна детектора: сигнал, если рост OI за bars баров (5m) >= oi_threshold
+# и рост цены <= рост OI * price_oi_ratio. Пользователь может переопределить
+# пороги через /oi_threshold. openInterestHist отдаёт максимум 500 баров (~41h)
+OI_WINDOWS = [
+    {"name": "4h", "bars": 48, "oi_threshold": OI_4H_THRESHOLD, "price_oi_ratio": PRICE_OI_RATIO},
+    {"name": "24h", "bars": 288, "oi_threshold": OI_24H_THRESHOLD, "price_oi_ratio": PRICE_OI_RATIO},
+]
 MIN_OI_USDT = 5_000_000  # фильтр мусора
 
 SIGNAL_COOLDOWN_HOURS = 3  # защита от спама
 
+# Приоритетный скан: горячие символы (близко к порогам) — каждый проход,
+# тёплые — реже, холодные — раз в COLD_EVERY_PASSES
+SCAN_BUDGET_SYMBOLS = 150  # символов за проход (≈2 запроса на символ)
+HOT_SCORE = 0.7            # доля порога OI, с которой символ считается горячим
+WARM_SCORE = 0.4
+WARM_EVERY_PASSES = 2
+COLD_EVERY_PASSES = 5
+SCORE_AGING = 0.05         # прибавка к приоритету за каждый пропущенный проход
+
 REQUEST_TIMEOUT = 10
 
+HISTORY_BARS = max(w["bars"] for w in OI_WINDOWS)  # одна история на символ для всех окон
+OI_HIST_MAX_BARS = 500  # лимит openInterestHist за один запрос
+
+if HISTORY_BARS > OI_HIST_MAX_BARS:
+    raise ValueError(f"OI_WINDOWS: окно {HISTORY_BARS} баров больше лимита openInterestHist ({OI_HIST_MAX_BARS})")
+for w in OI_WINDOWS:
+    if not (math.isfinite(w["oi_threshold"]) and w["oi_threshold"] > 0):
+        raise ValueError(f"OI_WINDOWS: oi_threshold окна {w['name']} должен быть > 0")
+BAR_SECONDS = 5 * 60
+BAR_MS = BAR_SECONDS * 1000
+
+ERROR_BACKOFF_BASE_SEC = 60    # первая пауза после ошибки
+ERROR_BACKOFF_MAX_SEC = 6 * 3600
+RATE_LIMIT_BACKOFF_SEC = 60    # пауза всего скана после 429/418, если нет Retry-After
+
 # =====================================================
 # ================== INIT =============================
 # =====================================================
 
 bot = Bot(token=TELEGRAM_TOKEN)
 
+# =====================================================
+# ================== USER STATE =======================
+# =====================================================
+
+# Неизменяемые срезы пользователей + индексы подписчиков.
+# Сканер берёт snapshot() без блокировок; изменения из Telegram-хендлеров
+# собирают новый срез (copy-on-write) и атомарно подменяют ссылку,
+# а запись в users.json идёт из одного потока с debounce
+class UsersSnapshot:
+    __slots__ = ("users", "alert_only", "trading", "blacklist_index", "trade_settings", "windows", "score_windows")
+
+    def __init__(self, users, alert_only, trading, blacklist_index, trade_settings, windows):
+        self.users = users                      # chat_id -> user dict (только чтение!)
+        self.alert_only = alert_only            # chat_id без торговли (только алерты)
+        self.trading = trading                  # chat_id с включённой торговлей
+        self.blacklist_index = blacklist_index  # symbol -> frozenset(chat_id, занёсших его в ЧС)
+        self.trade_settings = trade_settings    # chat_id -> готовые торговые настройки
+        self.windows = windows                  # chat_id -> окна OI, только у кого свои пороги
+        self.score_windows = loosest_windows(windows)  # самые мягкие пороги — для приоритета скана
+
+def build_trade_settings(user_data):
+    return {
+        "api_key": user_data.get("api_key", ""),
+        "api_secret": user_data.get("api_secret", ""),
+        "testnet": user_data.get("testnet", False),
+        "leverage": user_data.get("leverage", 10),
+        "margin_usdt": user_data.get("margin_usdt", 50),
+        "stop_loss_pct": user_data.get("stop_loss_pct", 2.0),
+        "take_profit_pct": user_data.get("take_profit_pct", 4.0),
+        "trailing_enabled": user_data.get("trailing_enabled", False),
+        "trailing_activation_pct": user_data.get("trailing_activation_pct", 1.5),
+        "trailing_rate_pct": round(user_data.get("trailing_rate_pct", 2) / 100, 3),
+        "volume_filter_enabled": user_data.get("volume_filter_enabled", False),
+        "volume_multiplier": user_data.get("volume_multiplier", 2.0),
+    }
+
+def resolve_windows(overrides):
+    # overrides: {"4h": {"oi_threshold": 12.0, "price_oi_ratio": 0.4}, ...}
+    if not overrides:
+        return None
+    return [dict(w, **overrides.get(w["name"], {})) for w in OI_WINDOWS]
+
+def loosest_windows(user_windows):
+    # По каждому окну — минимальный порог OI и максимальный price_oi_ratio
+    # среди глобальных и пользовательских настроек
+    loosest = [dict(w) for w in OI_WINDOWS]
+    for windows in user_windows.values():
+        for loose, w in zip(loosest, windows):
+            loose["oi_threshold"] = min(loose["oi_threshold"], w["oi_threshold"])
+            loose["price_oi_ratio"] = max(loose["price_oi_ratio"], w["price_oi_ratio"])
+    return loosest
+
+def build_snapshot(users):
+    alert_only = set()
+    trading = set()
+    blacklist_index = defaultdict(set)
+    trade_settings = {}
+    windows = {}
+    for chat_id, user_data in users.items():
+        user_windows = resolve_windows(user_data.get("oi_windows"))
+        if user_windows:
+            windows[chat_id] = user_windows
+        if user_data.get("trading_enabled", False):
+            trading.add(chat_id)
+            trade_settings[chat_id] = build_trade_settings(user_data)
+        else:
+            alert_only.add(chat_id)
+        for symbol in user_data.get("blacklist", []):
+            blacklist_index[symbol].add(chat_id)
+    return UsersSnapshot(
+        users,
+        frozenset(alert_only),
+        frozenset(trading),
+        {symbol: frozenset(holders) for symbol, holders in blacklist_index.items()},
+        trade_settings,
+        windows,
+    )
+
+def replace_users(snap, changes):
+    # Новый срез, где пересобраны только chat_id из changes (chat_id -> user или None);
+    # остальное переиспользуется, контейнеры копируются один раз на весь пакет
+    users = dict(snap.users)
+    alert_only = set(snap.alert_only)
+    trading = set(snap.trading)
+    blacklist_index = dict(snap.blacklist_index)
+    trade_settings = dict(snap.trade_settings)
+    windows = dict(snap.windows)
+
+    for chat_id, new_user in changes.items():
+        old_user = users.pop(chat_id, None)
+        alert_only.discard(chat_id)
+        trading.discard(chat_id)
+        trade_settings.pop(chat_id, None)
+        windows.pop(chat_id, None)
+
+        old_blacklist = set(old_user.get("blacklist", [])) if old_user else set()
+        new_blacklist = set(new_user.get("blacklist", [])) if new_user else set()
+        for symbol in old_blacklist - new_blacklist:
+            holders = blacklist_index[symbol] - {chat_id}
+            if holders:
+                blacklist_index[symbol] = holders
+            else:
+                del blacklist_index[symbol]
+        for symbol in new_blacklist - old_blacklist:
+            blacklist_index[symbol] = blacklist_index.get(symbol, frozenset()) | {chat_id}
+
+        if new_user is not None:
+            users[chat_id] = new_user
+            user_windows = resolve_windows(new_user.get("oi_windows"))
+            if user_windows:
+                windows[chat_id] = user_windows
+            if new_user.get("trading_enabled", False):
+                trading.add(chat_id)
+                trade_settings[chat_id] = build_trade_settings(new_user)
+            else:
+                alert_only.add(chat_id)
+
+    return UsersSnapshot(users, frozenset(alert_only), frozenset(trading), blacklist_index, trade_settings, windows)
+
+class UserStore:
+    def __init__(self, debounce_sec=USERS_SAVE_DEBOUNCE_SEC):
+        self.debounce_sec = debounce_sec
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._save_lock = threading.Lock()
+        self._last_change = 0.0
+        self._snapshot = build_snapshot(load_users())
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+
+    def snapshot(self):
+        return self._snapshot
+
+    def get(self, chat_id):
+        return self._snapshot.users.get(chat_id)
+
+    def put(self, chat_id, user_data):
+        with self._lock:
+            self._commit({chat_id: copy.deepcopy(user_data)})
+
+    def remove(self, chat_id):
+        with self._lock:
+            if chat_id in self._snapshot.users:
+                self._commit({chat_id: None})
+
+    def update(self, chat_id, fn):
+        # fn меняет копию пользователя; KeyError, если пользователя нет
+        with self._lock:
+            user_data = copy.deepcopy(self._snapshot.users[chat_id])
+            fn(user_data)
+            self._commit({chat_id: user_data})
+            return user_data
+
+    def update_many(self, chat_ids, fn):
+        # Одно изменение для пачки пользователей -> один новый срез.
+        # Отписавшиеся пропускаются; возвращает список обновлённых chat_id
+        with self._lock:
+            changes = {}
+            for chat_id in chat_ids:
+                user_data = self._snapshot.users.get(chat_id)
+                if user_data is None:
+                    continue
+                user_data = copy.deepcopy(user_data)
+                fn(user_data)
+                changes[chat_id] = user_data
+            if changes:
+                self._commit(changes)
+            return list(changes)
+
+    def set_fields(self, chat_id, **fields):
+        return self.update(chat_id, lambda user_data: user_data.update(fields))
+
+    def toggle(self, chat_id, key):
+        def flip(user_data):
+            user_data[key] = not user_data.get(key, False)
+        return self.update(chat_id, flip)
+
+    def _commit(self, changes):
+        self._snapshot = replace_users(self._snapshot, changes)
+        self._last_change = time.monotonic()
+        self._dirty.set()
+
+    def _writer_loop(self):
+        # Пишем, только когда изменения стихли на debounce_sec -> серия = одна запись
+        while True:
+            self._dirty.wait()
+            while True:
+                quiet = time.monotonic() - self._last_change
+                if quiet >= self.debounce_sec:
+                    break
+                time.sleep(self.debounce_sec - quiet)
+            with self._save_lock:
+                self._save()
+
+    def _save(self):
+        # Вызывать под self._save_lock
+        self._dirty.clear()
+        try:
+            save_users(self._snapshot.users)
+        except Exception as e:
+            print(f"Users save error: {e}")
+
+    def flush(self):
+        # Синхронно дописываем то, что ещё ждёт debounce (выход / рестарт).
+        # Под локом: если writer как раз пишет — дожидаемся его, а не выходим сразу
+        with self._save_lock:
+            if self._dirty.is_set():
+                self._save()
+
+user_store = UserStore()
+atexit.register(user_store.flush)
+
 # =====================================================
 # ================== UTILS ============================
 # =====================================================
@@ -68,11 +327,16 @@ def send_alert(chat_id, text):
     except Exception as e:
         print(f"Telegram error {chat_id}: {e}")
 
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 def binance_get(endpoint, params=None):
     url = BINANCE_FAPI_URL + endpoint
     r = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 # =====================================================
 # ================== DATA =============================
@@ -80,13 +344,17 @@ def binance_get(endpoint, params=None):
 
 def get_symbols():
     data = binance_get("/fapi/v1/exchangeInfo")
-    return [
-        s["symbol"]
+    symbols = [
+        s
         for s in data["symbols"]
         if s["contractType"] == "PERPETUAL"
         and s["quoteAsset"] == "USDT"
         and s["status"] == "TRADING"
     ]
+    for s in symbols:
+        if s.get("onboardDate"):
+            mark_listing(s["symbol"], s["onboardDate"] / 1000)
+    return [s["symbol"] for s in symbols]
 
 def get_oi_hist(symbol, limit):
     return binance_get(
@@ -108,135 +376,420 @@ def get_klines(symbol, limit):
         }
     )
 
+# Колонки array вместо списков строк: строки ответа копируются
+# list comprehension'ом (быстрее генератора) и сразу отбрасываются
+def oi_columns_from_rows(rows):
+    return {
+        "ts": array("q", [r["timestamp"] for r in rows]),
+        "oi_value": array("d", [float(r["sumOpenInterestValue"]) for r in rows]),
+    }
+
+def kline_columns_from_rows(rows):
+    return {
+        "ts": array("q", [k[0] for k in rows]),
+        "close": array("d", [float(k[4]) for k in rows]),
+        "volume": array("d", [float(k[5]) for k in rows]),
+    }
+
+def get_oi_columns(symbol, limit):
+    return oi_columns_from_rows(get_oi_hist(symbol, limit))
+
+def get_kline_columns(symbol, limit):
+    return kline_columns_from_rows(get_klines(symbol, limit))
+
 # =====================================================
-# ================== CORE LOGIC =======================
+# ================== SYMBOL HEALTH ====================
 # =====================================================
 
-def check_symbol(symbol):
+# symbol -> {"errors", "last_error", "last_error_time", "next_eligible", "history_until"}
+symbol_health = {}
+
+def get_health(symbol):
+    return symbol_health.setdefault(symbol, {
+        "errors": 0,
+        "last_error": None,
+        "last_error_time": None,
+        "next_eligible": 0.0,
+        "history_until": 0.0,
+    })
+
+def mark_listing(symbol, onboard_ts):
+    # До листинга + 24h нет полной истории OI — не тратим на символ запросы
+    health = get_health(symbol)
+    health["history_until"] = max(health["history_until"], onboard_ts + HISTORY_BARS * BAR_SECONDS)
+
+def mark_short_history(symbol, bars):
+    health = get_health(symbol)
+    health["history_until"] = time.time() + (HISTORY_BARS - bars) * BAR_SECONDS
+
+def record_symbol_ok(symbol):
+    health = symbol_health.get(symbol)
+    if health and health["errors"]:
+        health["errors"] = 0
+        health["next_eligible"] = 0.0
+
+def record_symbol_error(symbol, error):
+    health = get_health(symbol)
+    health["errors"] += 1
+    response = getattr(error, "response", None)
+    if response is not None:
+        health["last_error"] = f"HTTP {response.status_code}"
+    else:
+        health["last_error"] = type(error).__name__
+    now = time.time()
+    health["last_error_time"] = now
+    delay = min(ERROR_BACKOFF_BASE_SEC * 2 ** (health["errors"] - 1), ERROR_BACKOFF_MAX_SEC)
+    health["next_eligible"] = now + delay
+
+api_backoff_until = 0.0   # глобальная пауза после 429/418 — лимит на весь API, не на символ
+
+def is_rate_limited(error):
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in (418, 429)
+
+def note_rate_limit(error):
+    global api_backoff_until
     try:
-        oi_4h = get_oi_hist(symbol, 48)
-        oi_24h = get_oi_hist(symbol, 288)
+        delay = float(error.response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        delay = RATE_LIMIT_BACKOFF_SEC
+    api_backoff_until = max(api_backoff_until, time.time() + delay)
+
+def symbol_eligible(symbol, now):
+    health = symbol_health.get(symbol)
+    if health is None:
+        return True
+    return now >= health["next_eligible"] and now >= health["history_until"]
+
+def health_report(now=None):
+    now = now or time.time()
+    backoff = []
+    young = []
+    for symbol, health in list(symbol_health.items()):
+        if now < health["next_eligible"]:
+            backoff.append((symbol, health))
+        elif now < health["history_until"]:
+            young.append((symbol, health))
+
+    lines = [
+        "<b>🩺 Символы</b>",
+        f"Всего отслеживается: {len(symbol_health)}",
+        f"В backoff после ошибок: {len(backoff)}",
+        f"Мало истории OI: {len(young)}",
+    ]
+    if now < api_backoff_until:
+        lines.append(f"⛔ Лимит API: пауза ещё {(api_backoff_until - now) / 60:.0f} мин")
+    if backoff:
+        lines.append("")
+        lines.append("<b>Backoff:</b>")
+        for symbol, health in sorted(backoff, key=lambda x: -x[1]["errors"])[:20]:
+            wait_min = (health["next_eligible"] - now) / 60
+            lines.append(f"• {symbol}: {health['errors']} ош., {health['last_error']}, ещё {wait_min:.0f} мин")
+    if young:
+        lines.append("")
+        lines.append("<b>Ждут 24h истории:</b>")
+        for symbol, health in sorted(young, key=lambda x: x[1]["history_until"])[:20]:
+            until = datetime.utcfromtimestamp(health["history_until"]).strftime("%Y-%m-%d %H:%M")
+            lines.append(f"• {symbol}: до {until} UTC")
+    return "\n".join(lines)
 
-        if len(oi_24h) < 288:
-            return
+# =====================================================
+# ================== OI DETECTOR ======================
+# =====================================================
+
+class BarSeries:
+    # Кольцевой буфер последних size баров: значение N баров назад — O(1),
+    # новый бар — O(1), текущий (незакрытый) бар перезаписывается по ts
+    __slots__ = ("size", "buf", "count", "last_ts")
+
+    def __init__(self, size):
+        self.size = size
+        self.buf = array("d", bytes(8 * size))
+        self.count = 0
+        self.last_ts = None
+
+    def __len__(self):
+        return min(self.count, self.size)
 
-        oi_now = float(oi_4h[-1]["sumOpenInterestValue"])
-        oi_4h_ago = float(oi_4h[0]["sumOpenInterestValue"])
-        oi_24h_ago = float(oi_24h[0]["sumOpenInterestValue"])
-        
-        if oi_now < MIN_OI_USDT:
+    def push(self, ts, value):
+        if self.last_ts is not None and ts <= self.last_ts:
+            if ts == self.last_ts:
+                self.buf[(self.count - 1) % self.size] = value
             return
+        self.buf[self.count % self.size] = value
+        self.count += 1
+        self.last_ts = ts
+
+    def extend(self, ts_column, values):
+        for ts, value in zip(ts_column, values):
+            self.push(ts, value)
+
+    def last(self):
+        return self.buf[(self.count - 1) % self.size]
+
+    def window_start(self, bars):
+        # Первое значение окна из bars баров (как list[-bars])
+        return self.buf[(self.count - bars) % self.size]
+
+class SymbolHistory:
+    __slots__ = ("oi", "close")
+
+    def __init__(self):
+        self.oi = BarSeries(HISTORY_BARS)
+        self.close = BarSeries(HISTORY_BARS)
+
+symbol_history = {}   # symbol -> SymbolHistory
+
+def bars_to_fetch(series):
+    # Первый раз — вся история, дальше — только новые бары (+ перекрытие)
+    if series.last_ts is None:
+        return HISTORY_BARS
+    missing = int((time.time() * 1000 - series.last_ts) // BAR_MS) + 2
+    return max(2, min(missing, HISTORY_BARS))
+
+def window_metrics(history):
+    # name -> (oi_growth, price_growth) для всех окон, на которые хватает истории
+    oi_now = history.oi.last()
+    price_now = history.close.last()
+    metrics = {}
+    for w in OI_WINDOWS:
+        bars = w["bars"]
+        if len(history.oi) < bars or len(history.close) < bars:
+            continue
+        metrics[w["name"]] = (
+            pct(oi_now, history.oi.window_start(bars)),
+            pct(price_now, history.close.window_start(bars)),
+        )
+    return metrics
+
+def fired_windows(windows, metrics):
+    fired = []
+    for w in windows:
+        if w["name"] not in metrics:
+            continue
+        oi_growth, price_growth = metrics[w["name"]]
+        if oi_growth >= w["oi_threshold"] and price_growth <= oi_growth * w["price_oi_ratio"]:
+            fired.append(w["name"])
+    return fired
 
-        oi_growth_4h = pct(oi_now, oi_4h_ago)
-        oi_growth_24h = pct(oi_now, oi_24h_ago)
+# =====================================================
+# ================== SCAN PRIORITY ====================
+# =====================================================
 
-        klines_4h = get_klines(symbol, 48)
-        klines_24h = get_klines(symbol, 288)
+symbol_scores = {}      # symbol -> momentum score с прошлого прохода
+symbol_last_pass = {}   # symbol -> номер прохода последней проверки
+
+def momentum_score(metrics, windows):
+    # 1.0 = порог OI достигнут; цена, обгоняющая OI, снижает приоритет
+    score = 0.0
+    for w in windows:
+        if w["name"] not in metrics:
+            continue
+        oi_growth, price_growth = metrics[w["name"]]
+        window_score = oi_growth / w["oi_threshold"]
+        if price_growth > oi_growth * w["price_oi_ratio"]:
+            window_score *= 0.5
+        score = max(score, window_score)
+    return score
+
+def recheck_every(score):
+    if score >= HOT_SCORE:
+        return 1
+    if score >= WARM_SCORE:
+        return WARM_EVERY_PASSES
+    return COLD_EVERY_PASSES
+
+def scan_order(symbols, pass_no, now):
+    due = []
+    for symbol in symbols:
+        if not symbol_eligible(symbol, now):
+            continue  # backoff / мало истории — без запросов
+        score = symbol_scores.get(symbol)
+        if score is None:
+            due.append((float("inf"), symbol))  # ещё не проверяли
+            continue
+        waited = pass_no - symbol_last_pass.get(symbol, 0)
+        if waited >= recheck_every(score):
+            due.append((score + waited * SCORE_AGING, symbol))
+    due.sort(key=lambda x: -x[0])
+    return [symbol for _, symbol in due[:SCAN_BUDGET_SYMBOLS]]
 
-        price_now = float(klines_4h[-1][4])
-        price_4h_ago = float(klines_4h[0][4])
-        price_24h_ago = float(klines_24h[0][4])
+# =====================================================
+# ================== CORE LOGIC =======================
+# =====================================================
 
-        price_growth_4h = pct(price_now, price_4h_ago)
-        price_growth_24h = pct(price_now, price_24h_ago)
+def update_symbol_data(symbol):
+    # Фаза загрузки: только здесь ошибки идут в здоровье символа
+    history = symbol_history.get(symbol) or SymbolHistory()
 
-        signal_4h = (
-            oi_growth_4h >= OI_4H_THRESHOLD and
-            price_growth_4h <= oi_growth_4h * PRICE_OI_RATIO
-        )
+    oi = get_oi_columns(symbol, bars_to_fetch(history.oi))
+    history.oi.extend(oi["ts"], oi["oi_value"])
 
-        signal_24h = (
-            oi_growth_24h >= OI_24H_THRESHOLD and
-            price_growth_24h <= oi_growth_24h * PRICE_OI_RATIO
-        )
+    if len(history.oi) < HISTORY_BARS:
+        symbol_history.pop(symbol, None)
+        mark_short_history(symbol, len(history.oi))
+        return
+    symbol_history[symbol] = history
 
-        if not (signal_4h or signal_24h):
-            return
+    oi_now = history.oi.last()
+
+    if oi_now < MIN_OI_USDT:
+        record_symbol_ok(symbol)
+        symbol_scores[symbol] = 0.0
+        return
+
+    klines = get_kline_columns(symbol, bars_to_fetch(history.close))
+    history.close.extend(klines["ts"], klines["close"])
+
+    price_now = history.close.last()
+    metrics = window_metrics(history)
+
+    record_symbol_ok(symbol)
+    symbol_scores[symbol] = momentum_score(metrics, user_store.snapshot().score_windows)
+    return metrics, price_now, oi_now
+
+def dispatch_signal(symbol, metrics, price_now, oi_now):
+    snap = user_store.snapshot()
+    global_fired = fired_windows(OI_WINDOWS, metrics)
 
-        period = "4h" if signal_4h else "24h"
+    # Глобальный сигнал — рассылка всем подписчикам; иначе проверяем
+    # только пользователей со своими порогами (snap.windows)
+    if global_fired:
+        alert_targets = snap.alert_only
+        trading_targets = snap.trading
+    elif snap.windows:
+        alert_targets = [c for c in snap.windows if c in snap.alert_only]
+        trading_targets = [c for c in snap.windows if c in snap.trading]
+    else:
+        return
 
-        # Process for each user
-        for chat_id_str, user_data in list(users.items()):
-            chat_id = int(chat_id_str)
-            if not user_data.get("trading_enabled", False):
-                # Still send alert if subscribed, even if trading disabled
-                send_alert(chat_id, generate_alert_text(symbol, period, oi_growth_4h, oi_growth_24h, price_growth_4h, price_growth_24h, price_now, oi_now))
+    alert_texts = {}
+
+    def alert_for(chat_id_str):
+        windows = snap.windows.get(chat_id_str)
+        fired = global_fired if windows is None else fired_windows(windows, metrics)
+        if not fired:
+            return None
+        period = fired[0]
+        if period not in alert_texts:
+            alert_texts[period] = generate_alert_text(symbol, period, metrics, price_now, oi_now)
+        return alert_texts[period]
+
+    blacklisted = snap.blacklist_index.get(symbol, ())
+    signal_time = datetime.utcnow().isoformat()
+
+    def mark_signal(user_data):
+        user_data.setdefault("last_signal_time", {})[symbol] = signal_time
+
+    def collect_due(targets):
+        # Те, у кого сработало окно и прошёл cooldown по символу
+        due = {}
+        for chat_id_str in targets:
+            alert_text = alert_for(chat_id_str)
+            if not alert_text:
                 continue
 
-            last_signals = user_data.get("last_signal_time", {})
+            last_signals = snap.users[chat_id_str].get("last_signal_time", {})
             if symbol in last_signals and datetime.utcnow() - datetime.fromisoformat(last_signals[symbol]) < timedelta(hours=SIGNAL_COOLDOWN_HOURS):
                 continue
+            due[chat_id_str] = alert_text
+        return due
+
+    # Cooldown общий для алертов и сделок: горячие символы перепроверяются
+    # каждый проход, без него alert-only получали бы алерт каждую минуту
+    alert_due = collect_due(alert_targets)
+    due = collect_due(trading_targets)
+
+    # Обновляем cooldown всем одним срезом (отписавшихся пропускаем)
+    marked = set(user_store.update_many([*alert_due, *due], mark_signal)) if alert_due or due else set()
+
+    # Alert-only subscribers: торговля выключена, просто шлём алерт
+    for chat_id_str, alert_text in alert_due.items():
+        if chat_id_str in marked:
+            send_alert(int(chat_id_str), alert_text)
+
+    # Trading subscribers
+    for chat_id_str, alert_text in due.items():
+        if chat_id_str not in marked:
+            continue
+        cfg = snap.trade_settings[chat_id_str]
+        chat_id = int(chat_id_str)
+
+        # Send alert
+        send_alert(chat_id, alert_text)
 
-            # Update cooldown
-            last_signals[symbol] = datetime.utcnow().isoformat()
-            user_data["last_signal_time"] = last_signals
-            save_users(users)
-
-            # Send alert
-            send_alert(chat_id, generate_alert_text(symbol, period, oi_growth_4h, oi_growth_24h, price_growth_4h, price_growth_24h, price_now, oi_now))
-
-            # Open trade
-            try:
-                api_key = user_data["api_key"]
-                api_secret = user_data["api_secret"]
-                testnet = user_data.get("testnet", False)
-                leverage = user_data.get("leverage", 10)
-                margin_usdt = user_data.get("margin_usdt", 50)
-                stop_loss_pct = user_data.get("stop_loss_pct", 2.0)
-                take_profit_pct = user_data.get("take_profit_pct", 4.0)
-                trailing_enabled = user_data.get("trailing_enabled", False)
-                trailing_activation_pct = user_data.get("trailing_activation_pct", 1.5)
-                trailing_rate_pct = round(user_data.get("trailing_rate_pct", 2) / 100, 3)
-
-                bx = BingxClient(api_key, api_secret, testnet=testnet)
-                if chat_id != 949808523:
-                # Set leverage if needed (assuming client has method, add if not)
-                    bx.set_leverage(symbol, 'long',leverage)  # Add this method if necessary
-
-                s = symbol.replace('USDT', '-USDT')
-                qty = (margin_usdt * leverage) / price_now
-
-                stop_price = price_now * (1 - stop_loss_pct / 100)
-                tp_price = price_now * (1 + take_profit_pct / 100)
-
-                precision = bx.count_decimal_places(price_now)
-                stop_price = round(stop_price, precision)
-                tp_price = round(tp_price, precision)
-                qty = round(qty, 0 if precision < 2 else 1)  # Adjust as per your logic
-                pos_side_BOTH = True if chat_id == 949808523 else False
-                if symbol in user_data.get("blacklist", []):
+        # Символ в чёрном списке — без сделки (и без лишних запросов к бирже)
+        if chat_id_str in blacklisted:
+            continue
+
+        # Open trade
+        try:
+            # === VOLUME FILTER ===
+            if cfg["volume_filter_enabled"]:
+                if not check_volume_filter(symbol, cfg["volume_multiplier"]):
                     continue
 
-                # === VOLUME FILTER ===
-                if user_data.get("volume_filter_enabled", False):
-                    multiplier = user_data.get("volume_multiplier", 2.0)
-                    if not check_volume_filter(symbol, multiplier):
-                        continue
-                    
-                resp = bx.place_market_order('long', qty, s, stop_price, tp_price, pos_side_BOTH)
-                print(f"Order placed for {chat_id} on {symbol}: {resp}")
+            leverage = cfg["leverage"]
+            margin_usdt = cfg["margin_usdt"]
+
+            bx = BingxClient(cfg["api_key"], cfg["api_secret"], testnet=cfg["testnet"])
+            if chat_id != 949808523:
+            # Set leverage if needed (assuming client has method, add if not)
+                bx.set_leverage(symbol, 'long',leverage)  # Add this method if necessary
+
+            s = symbol.replace('USDT', '-USDT')
+            qty = (margin_usdt * leverage) / price_now
 
-                if trailing_enabled:
-                    activation_price = price_now * (1 + trailing_activation_pct / 100)
-                    resp_trail = bx.set_trailing(s, 'long', qty, activation_price, trailing_rate_pct)
-                    print(f"Trailing set for {chat_id} on {symbol}: {resp_trail}")
+            stop_price = price_now * (1 - cfg["stop_loss_pct"] / 100)
+            tp_price = price_now * (1 + cfg["take_profit_pct"] / 100)
 
-            except Exception as e:
-                print(f"Trade error for {chat_id} on {symbol}: {e}")
-                send_alert(chat_id, f"Ошибка открытия сделки на {symbol}: {str(e)}")
+            precision = bx.count_decimal_places(price_now)
+            stop_price = round(stop_price, precision)
+            tp_price = round(tp_price, precision)
+            qty = round(qty, 0 if precision < 2 else 1)  # Adjust as per your logic
+            pos_side_BOTH = True if chat_id == 949808523 else False
 
+            resp = bx.place_market_order('long', qty, s, stop_price, tp_price, pos_side_BOTH)
+            print(f"Order placed for {chat_id} on {symbol}: {resp}")
+
+            if cfg["trailing_enabled"]:
+                activation_price = price_now * (1 + cfg["trailing_activation_pct"] / 100)
+                resp_trail = bx.set_trailing(s, 'long', qty, activation_price, cfg["trailing_rate_pct"])
+                print(f"Trailing set for {chat_id} on {symbol}: {resp_trail}")
+
+        except Exception as e:
+            print(f"Trade error for {chat_id} on {symbol}: {e}")
+            send_alert(chat_id, f"Ошибка открытия сделки на {symbol}: {str(e)}")
+
+def check_symbol(symbol):
+    try:
+        data = update_symbol_data(symbol)
     except Exception as e:
+        if is_rate_limited(e):
+            note_rate_limit(e)  # бан/лимит на весь API, символ не виноват
+        else:
+            record_symbol_error(symbol, e)
         print(f"{symbol}: {e}")
+        return
+
+    if data is None:
+        return
+
+    # Ошибки рассылки (битая запись пользователя и т.п.) не портят здоровье символа
+    try:
+        dispatch_signal(symbol, *data)
+    except Exception as e:
+        print(f"{symbol} dispatch error: {e}")
 
-def generate_alert_text(symbol, period, oi_growth_4h, oi_growth_24h, price_growth_4h, price_growth_24h, price_now, oi_now):
+def generate_alert_text(symbol, period, metrics, price_now, oi_now):
+    oi_lines = "".join(f"OI {name}: {oi_growth:.1f}%\n" for name, (oi_growth, _) in metrics.items())
+    price_lines = "".join(f"Цена {name}: {price_growth:.1f}%\n" for name, (_, price_growth) in metrics.items())
     return (
         f"<b>${symbol.replace('USDT', '')}</b>\n"
         f"🚨 <b>OI ALERT</b>\n"
         f"⏱ Период: {period}\n\n"
-        f"OI 4h: {oi_growth_4h:.1f}%\n"
-        f"OI 24h: {oi_growth_24h:.1f}%\n\n"
-        f"Цена 4h: {price_growth_4h:.1f}%\n"
-        f"Цена 24h: {price_growth_24h:.1f}%\n\n"
+        f"{oi_lines}\n"
+        f"{price_lines}\n"
         f"Текущая цена: {price_now:.4f}\n"
         f"OI: {oi_now/1e6:.1f}M USDT\n\n"
         f"<i>OI растёт быстрее цены → возможное накопление</i>"
@@ -254,22 +807,21 @@ def generate_alert_text(symbol, period, oi_growth_4h, oi_growth_24h, price_growt
 ) = range(12)
 
 def check_volume_filter(symbol, multiplier):
-    klines = get_klines(symbol, Vol_period)
+    volumes = get_kline_columns(symbol, Vol_period)["volume"]
 
-    if len(klines) < Vol_period:
+    if len(volumes) < Vol_period:
         return False
 
-    volumes = [float(k[5]) for k in klines[:-1]]  # без текущей
-    avg_volume = sum(volumes) / len(volumes)
+    avg_volume = sum(volumes[:-1]) / (len(volumes) - 1)  # без текущей
 
-    current_volume = float(klines[-1][5])
+    current_volume = volumes[-1]
 
     return current_volume >= avg_volume * multiplier
 
 def start(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    if chat_id not in users:
-        users[chat_id] = {
+    if user_store.get(chat_id) is None:
+        user_store.put(chat_id, {
             "trading_enabled": False,
             "testnet": False,
             "api_key": "",
@@ -287,16 +839,13 @@ def start(update: Update, context):
             "volume_filter_enabled": False,
             "volume_multiplier": 2.0,
             "blacklist": []
-        }
-        save_users(users)
+        })
     update.message.reply_text("✅ Подписка на OI-сигналы активирована. Используйте /settings для настроек.")
     return show_settings_menu(update, context)
 
 def stop(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    if chat_id in users:
-        del users[chat_id]
-        save_users(users)
+    user_store.remove(chat_id)
     update.message.reply_text("❌ Подписка отключена")
     return ConversationHandler.END
 
@@ -309,11 +858,11 @@ def show_settings_menu(update: Update, context):
     else:
         chat_id = str(update.effective_chat.id)
     
-    user = users.get(chat_id, {
+    user = user_store.get(chat_id) or {
         "trading_enabled": False, "testnet": False, "api_key": "", "api_secret": "",
         "leverage": 10, "margin_usdt": 50, "stop_loss_pct": 2.0, "take_profit_pct": 4.0,
         "trailing_enabled": False, "trailing_activation_pct": 1.5, "trailing_rate_pct": 0.5
-    })
+    }
 
     keyboard = [
         [InlineKeyboardButton(f"Торговля: {'✅ Вкл' if user.get('trading_enabled') else '❌ Выкл'}", callback_data='toggle_trading')],
@@ -353,7 +902,7 @@ def show_settings_menu(update: Update, context):
     return ConversationHandler.END
 def blacklist_show(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    blacklist = users.get(chat_id, {}).get("blacklist", [])
+    blacklist = (user_store.get(chat_id) or {}).get("blacklist", [])
 
     if not blacklist:
         update.message.reply_text("📭 Чёрный список пуст")
@@ -363,6 +912,50 @@ def blacklist_show(update: Update, context):
     text += "\n".join(f"• {s}" for s in sorted(blacklist))
 
     update.message.reply_text(text, parse_mode="HTML")
+def oi_threshold(update: Update, context):
+    chat_id = str(update.effective_chat.id)
+    names = [w["name"] for w in OI_WINDOWS]
+
+    if len(context.args) < 2 or context.args[0] not in names:
+        windows = resolve_windows((user_store.get(chat_id) or {}).get("oi_windows")) or OI_WINDOWS
+        text = "<b>📈 Окна OI:</b>\n\n"
+        text += "\n".join(
+            f"• {w['name']}: OI ≥ {w['oi_threshold']}%, цена ≤ OI × {w['price_oi_ratio']}"
+            for w in windows
+        )
+        text += f"\n\nИспользование: /oi_threshold {names[0]} 12 [0.5] или /oi_threshold {names[0]} reset"
+        update.message.reply_text(text, parse_mode="HTML")
+        return
+
+    name = context.args[0]
+
+    if context.args[1].lower() == "reset":
+        def apply(user_data):
+            user_data.get("oi_windows", {}).pop(name, None)
+        reply = f"✅ Пороги окна {name} сброшены"
+    else:
+        try:
+            override = {"oi_threshold": float(context.args[1])}
+            if len(context.args) > 2:
+                override["price_oi_ratio"] = float(context.args[2])
+        except ValueError:
+            update.message.reply_text("❌ Неверный формат. Попробуйте снова.")
+            return
+
+        if not all(math.isfinite(v) and v > 0 for v in override.values()):
+            update.message.reply_text("❌ Значения должны быть положительными числами.")
+            return
+
+        def apply(user_data):
+            user_data.setdefault("oi_windows", {})[name] = override
+        reply = f"✅ Окно {name}: порог OI {override['oi_threshold']}%"
+
+    user_store.update(chat_id, apply)
+    update.message.reply_text(reply)
+
+def symbols_health(update: Update, context):
+    update.message.reply_text(health_report(), parse_mode="HTML")
+
 def button_handler(update: Update, context):
     query = update.callback_query
     query.answer()  # Обязательно отвечаем на callback!
@@ -370,16 +963,13 @@ def button_handler(update: Update, context):
     data = query.data
 
     if data == 'toggle_trading':
-        users[chat_id]['trading_enabled'] = not users[chat_id].get('trading_enabled', False)
-        save_users(users)
+        user_store.toggle(chat_id, 'trading_enabled')
 
     elif data == 'toggle_testnet':
-        users[chat_id]['testnet'] = not users[chat_id].get('testnet', False)
-        save_users(users)
+        user_store.toggle(chat_id, 'testnet')
 
     elif data == 'toggle_trailing':
-        users[chat_id]['trailing_enabled'] = not users[chat_id].get('trailing_enabled', False)
-        save_users(users)
+        user_store.toggle(chat_id, 'trailing_enabled')
     elif data == 'set_volume_multiplier':
         context.user_data['setting'] = 'set_volume_multiplier'
         query.edit_message_text("Введите volume multiplier (например 2.0):")
@@ -390,8 +980,7 @@ def button_handler(update: Update, context):
         query.edit_message_text(f"Введите новое значение для <b>{field_name}</b>:", parse_mode="HTML")
         return get_state(data)
     elif data == 'toggle_volume_filter':
-        users[chat_id]['volume_filter_enabled'] = not users[chat_id].get('volume_filter_enabled', False)
-        save_users(users)
+        user_store.toggle(chat_id, 'volume_filter_enabled')
 
     
     # Если мы здесь — значит, была toggle-операция, обновляем меню
@@ -448,10 +1037,12 @@ def blacklist_add(update: Update, context):
 
     symbol = context.args[0].upper()
 
-    users[chat_id].setdefault("blacklist", [])
-    if symbol not in users[chat_id]["blacklist"]:
-        users[chat_id]["blacklist"].append(symbol)
-        save_users(users)
+    def add(user_data):
+        blacklist = user_data.setdefault("blacklist", [])
+        if symbol not in blacklist:
+            blacklist.append(symbol)
+
+    user_store.update(chat_id, add)
 
     update.message.reply_text(f"⛔ {symbol} добавлен в чёрный список")
 
@@ -464,9 +1055,11 @@ def blacklist_remove(update: Update, context):
 
     symbol = context.args[0].upper()
 
-    if symbol in users[chat_id].get("blacklist", []):
-        users[chat_id]["blacklist"].remove(symbol)
-        save_users(users)
+    def remove(user_data):
+        if symbol in user_data.get("blacklist", []):
+            user_data["blacklist"].remove(symbol)
+
+    user_store.update(chat_id, remove)
 
     update.message.reply_text(f"✅ {symbol} удалён из чёрного списка")
     
@@ -480,8 +1073,7 @@ def set_value(update: Update, context, key, type_func=str):
             value = text.lower() in ['true', '1', 'yes', 'да', 'вкл']
         else:
             value = type_func(text)
-        users[chat_id][key] = value
-        save_users(users)
+        user_store.set_fields(chat_id, **{key: value})
         update.message.reply_text(f"✅ {key.replace('_', ' ').title()} установлен: {value}")
     except ValueError:
         update.message.reply_text("❌ Неверный формат. Попробуйте снова.")
@@ -522,24 +1114,40 @@ def telegram_bot():
     dp.add_handler(CommandHandler("blacklist_add", blacklist_add))
     dp.add_handler(CommandHandler("blacklist_show", blacklist_show))
     dp.add_handler(CommandHandler("blacklist_remove", blacklist_remove))
+    dp.add_handler(CommandHandler("health", symbols_health))
+    dp.add_handler(CommandHandler("oi_threshold", oi_threshold))
     dp.add_handler(conv_handler)
     dp.add_handler(CommandHandler("stop", stop))
 
     updater.start_polling()
 
-import threading
 threading.Thread(target=telegram_bot, daemon=True).start()
 
+def handle_sigterm(signum, frame):
+    # systemd/docker останавливают процесс SIGTERM'ом; без обработчика atexit
+    # не срабатывает и несохранённые cooldown'ы теряются
+    sys.exit(0)
+
 def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     symbols = get_symbols()
     print(f"[INFO] Symbols loaded: {len(symbols)}")
 
+    pass_no = 0
     while True:
         start_time = time.time()
-        print(f"[INFO] Scan started {datetime.utcnow()}")
-
-        for symbol in symbols:
+        pass_no += 1
+        batch = scan_order(symbols, pass_no, start_time)
+        print(f"[INFO] Scan started {datetime.utcnow()} ({len(batch)} symbols)")
+
+        for symbol in batch:
+            wait = api_backoff_until - time.time()
+            if wait > 0:
+                print(f"[WARN] API rate limit, pause {wait:.0f}s")
+                time.sleep(wait)
             check_symbol(symbol)
+            symbol_last_pass[symbol] = pass_no
             time.sleep(0.15)  # rate limit protection
 
         elapsed = time.time() - start_time